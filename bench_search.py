@@ -0,0 +1,87 @@
+"""Compare fuzzy search with plain substring matching.
+
+Usage: python bench_search.py [N]
+
+Generates N synthetic paths (default 500000) and types a few queries one
+character at a time. For the old ``str_match`` filter it measures how long
+the UI is blocked per keystroke. The fuzzy search runs in time slices, so
+for it the longest slice and the time until the ranking is complete are
+measured.
+"""
+
+import random
+import sys
+import time
+
+import cplay
+
+WORDS = [
+    'love', 'night', 'blue', 'dance', 'river', 'fire', 'dream', 'heart',
+    'road', 'light', 'rain', 'home', 'summer', 'ghost', 'gold', 'city',
+]
+QUERIES = ['river', 'blue dance', 'ghst', 'mmr ght']
+
+
+def make_paths(n):
+    rng = random.Random(0)
+    paths = []
+    for i in range(n):
+        artist = ' '.join(rng.sample(WORDS, 2)).title()
+        album = ' '.join(rng.sample(WORDS, 3)).title()
+        title = ' '.join(rng.sample(WORDS, 3))
+        paths.append(f'{artist}/{album}/{i % 20 + 1:02} {title}.mp3')
+    return paths
+
+
+def bench_str_match(paths, query):
+    times = []
+    base = paths
+    for i in range(1, len(query) + 1):
+        start = time.perf_counter()
+        base = [p for p in base if cplay.str_match(query[:i], p)]
+        times.append(time.perf_counter() - start)
+    return times, base
+
+
+def bench_matcher(matcher, query):
+    slices = []
+    totals = []
+    matches = None
+    for i in range(1, len(query) + 1):
+        start = time.perf_counter()
+        job = matcher.start(query[:i], matches)
+        while not job.done:
+            slice_start = time.perf_counter()
+            job.step()
+            slices.append(time.perf_counter() - slice_start)
+        totals.append(time.perf_counter() - start)
+        matches = job.matches
+    return slices, totals, job.results()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    paths = make_paths(n)
+
+    start = time.perf_counter()
+    matcher = cplay.Matcher(paths)
+    print(f'{n} paths, building the matcher took '
+          f'{(time.perf_counter() - start) * 1000:.0f} ms')
+
+    for query in QUERIES:
+        old_times, old = bench_str_match(paths, query)
+        slices, totals, new = bench_matcher(matcher, query)
+        print(f'\n{query!r}')
+        print(f'  str_match: {len(old):7} results, blocked per keystroke '
+              f'max {max(old_times) * 1000:6.1f} ms, '
+              f'mean {sum(old_times) / len(old_times) * 1000:6.1f} ms')
+        print(f'  fuzzy:     {len(new):7} results, longest slice '
+              f'{max(slices) * 1000:6.1f} ms, complete after '
+              f'max {max(totals) * 1000:6.1f} ms, '
+              f'mean {sum(totals) / len(totals) * 1000:6.1f} ms')
+        if new:
+            print(f'  best match: {paths[new[0]]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Check that the filelist and list searches can be typed into.
+
+Usage: python check_search.py
+
+Creates a small temporary music directory and feeds keys to the
+application the same way the main loop does, waiting for the directory
+scan and stepping the searches until they are done.
+"""
+
+import os
+import select
+import sys
+import tempfile
+
+import cplay
+
+
+def type_keys(keys):
+    for key in keys:
+        cplay.app.process_key(key)
+        while cplay.filelist.scanning:
+            select.select([cplay.fs.wake_in], [], [])
+            cplay.fs.on_wake(cplay.fs.wake_in)
+        while cplay.app.tab.searching:
+            cplay.app.tab.step_search()
+
+
+def check(name, value, expected):
+    if value != expected:
+        print(f'{name}: expected {expected!r}, got {value!r}')
+        return False
+    return True
+
+
+def main():
+    cplay.app = cplay.Application()
+    with tempfile.TemporaryDirectory() as root:
+        os.mkdir(os.path.join(root, 'album'))
+        for name in ['album/one.ogg', 'album/two.ogg', 'three.mp3']:
+            open(os.path.join(root, name), 'w').close()
+        cplay.filelist.set_path(root, fail_silently=False)
+        ok = True
+
+        # recursive search without a previous / search
+        type_keys('stw')
+        ok &= check('filter', cplay.filelist.items, [f'{root}/album/two.ogg'])
+        type_keys('\x1b')
+
+        # recursive search after a / search
+        cplay.filelist.set_path(root, refresh=True)
+        type_keys('/thr\n')
+        ok &= check('search', cplay.filelist.cursor, 1)
+        type_keys('son')
+        ok &= check('filter', cplay.filelist.items, [f'{root}/album/one.ogg'])
+
+    print('ok' if ok else 'failed')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,34 @@
+"""A simple curses audio player."""
+
+import argparse
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
 import curses
 import functools
+import hashlib
+import heapq
+import itertools
 import json
 import os
+import queue
 import random
 import re
 import selectors
 import signal
 import socket
+import sqlite3
 import subprocess
 import sys
 import termios
+import threading
 import time
-from contextlib import contextmanager
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None
 
 __version__ = '5.4.0'
 
@@ -19,6 +36,60 @@ AUDIO_EXTENSIONS = [
     'mp3', 'ogg', 'oga', 'opus', 'flac', 'm4a', 'm4b', 'wav', 'mid', 'wma'
 ]
 
+# number of entries that are added per main loop iteration
+ADD_BATCH = 200
+
+# clients that fall behind by more than this many bytes are detached
+CLIENT_BUFFER = 2**20
+
+# seconds between session snapshots
+SESSION_INTERVAL = 60
+
+# seconds to wait for the filesystem before considering it unreachable
+FS_TIMEOUT = 0.5
+
+# number of search results that are ranked, the rest keep their order
+SEARCH_LIMIT = 1000
+# seconds of searching per main loop iteration
+SEARCH_STEP = 0.015
+
+# number of rows that are fetched from the library index at once
+LIBRARY_PAGE = 100
+# number of files that are indexed before changes become visible
+LIBRARY_BATCH = 1000
+
+LIBRARY_VIEWS = {
+    'Artists': ['artist', 'album', 'path'],
+    'Genres': ['genre', 'artist', 'album', 'path'],
+    'Recently added': ['path'],
+}
+
+LIBRARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    added REAL,
+    artist TEXT,
+    album TEXT,
+    genre TEXT,
+    tracknumber INTEGER,
+    title TEXT
+);
+CREATE INDEX IF NOT EXISTS tracks_artist
+    ON tracks (artist, album, tracknumber, path);
+CREATE INDEX IF NOT EXISTS tracks_genre ON tracks (genre, artist, album);
+CREATE INDEX IF NOT EXISTS tracks_added ON tracks (added);
+"""
+
+# number of upcoming tracks that are read ahead
+PREFETCH_AHEAD = 3
+# number of bytes that are read ahead in total, split between the tracks
+PREFETCH_BUDGET = 24 * 2**20
+# number of track starts that are used to compare warm and cold startup times
+PREFETCH_SAMPLES = 20
+
+SORT_MODES = ['natural', 'directory', 'tags', 'duration']
+
 HELP = """Global
 ------
 Up, k        : move to previous item
@@ -33,18 +104,28 @@ n            : next track
 x, Space     : toggle play/pause
 Left, Right  : seek backward/forward
 /            : search
-[, ]         : previous/next search match
-Esc          : cancel
+[, ]         : previous/next search match (best first)
+Esc          : cancel (also stops adding a directory)
 0..9         : volume control
 h            : help
-q, Q         : quit
+q            : quit (detach when attached to a daemon)
+Q            : quit (stop the daemon)
 
 Filelist
 --------
-a            : add to playlist
+a            : add to playlist (+ marks queued files)
 s            : recursive search
 BS           : go to parent dir
 r            : refresh
+v            : switch to library view
+
+Library
+-------
+Enter        : open item or play track
+a            : add all tracks of item to playlist
+BS           : go back
+r            : update index
+v            : switch to file view
 
 Playlist
 --------
@@ -52,6 +133,8 @@ d, D         : delete item/all
 m, M         : move item down/up
 r, R         : toggle repeat/random
 s, S         : shuffle/sort playlist
+o            : cycle sort order (natural/directory/tags/duration)
+u, U         : toggle skip duplicates/remove duplicates
 w            : enter filename for current playlist
 C            : close current playlist
 @            : jump to current track"""
@@ -79,8 +162,125 @@ def str_match(query, s):
     return all(q in s.casefold() for q in query.casefold().split())
 
 
-def resize(*_args):
-    os.write(app.resize_out, b'.')
+def fuzzy_score(term, s):
+    """Score how well ``term`` matches ``s`` as a subsequence.
+
+    Matches at word boundaries, in the basename and consecutive matches get
+    bonuses, gaps get a penalty. Both strings are expected to be casefolded.
+    """
+    pos = -1
+    for c in term:
+        pos = s.find(c, pos + 1)
+        if pos == -1:
+            return None
+
+    # walk back from the end of the first match to find the tightest window
+    positions = [pos]
+    for c in reversed(term[:-1]):
+        pos = s.rfind(c, 0, pos)
+        positions.append(pos)
+
+    basename = s.rstrip('/').rfind('/') + 1
+    score = -(positions[0] - positions[-1] + 1 - len(term))
+    prev = None
+    for p in positions:
+        score += 1
+        if p == 0 or s[p - 1] in '/ _-.':
+            score += 8
+        if p >= basename:
+            score += 4
+        if prev == p + 1:
+            score += 6
+        prev = p
+    return score
+
+
+class SearchJob:
+    """Fuzzy search that can be advanced in small time slices.
+
+    The best matches are kept in a bounded heap, so results can be shown
+    (and improve) while the search is still running. Once it is done, the
+    remaining matches follow in their original order.
+    """
+
+    def __init__(self, strings, query, indices=None, limit=SEARCH_LIMIT):
+        self.strings = strings
+        self.terms = query.casefold().split()
+        self.limit = limit
+        if indices is None:
+            indices = range(len(strings))
+        self.todo = iter(indices)
+        self.matches = []
+        self.heap = []
+        self.done = False
+
+    def process(self, i):
+        s = self.strings[i]
+        score = 0
+        for term in self.terms:
+            term_score = fuzzy_score(term, s)
+            if term_score is None:
+                return
+            score += term_score
+        self.matches.append(i)
+        item = (score, -len(s), -i)
+        if len(self.heap) < self.limit:
+            heapq.heappush(self.heap, item)
+        elif item > self.heap[0]:
+            heapq.heapreplace(self.heap, item)
+
+    def step(self, budget=SEARCH_STEP):
+        deadline = time.monotonic() + budget
+        while not self.done:
+            chunk = list(itertools.islice(self.todo, 256))
+            for i in chunk:
+                self.process(i)
+            if len(chunk) < 256:
+                self.done = True
+            elif time.monotonic() > deadline:
+                break
+
+    def results(self):
+        ranked = [-item[2] for item in sorted(self.heap, reverse=True)]
+        if self.done and len(self.matches) > len(ranked):
+            top = set(ranked)
+            ranked += [i for i in self.matches if i not in top]
+        return ranked
+
+
+class Matcher:
+    """Rank strings by how well they fuzzily match a query."""
+
+    def __init__(self, strings):
+        self.strings = [s.casefold() for s in strings]
+
+    def __len__(self):
+        return len(self.strings)
+
+    def start(self, query, indices=None, limit=SEARCH_LIMIT):
+        return SearchJob(self.strings, query, indices, limit)
+
+
+def split_digits(s):
+    # re.split() with a group alternates between text and digits, so the
+    # resulting tuples can be compared element by element
+    parts = re.split(r'([0-9]+)', s.casefold())
+    return tuple(int(p) if i % 2 else p for i, p in enumerate(parts))
+
+
+def natural_key(path):
+    return split_digits(path)
+
+
+def directory_key(path):
+    dirname, basename = os.path.split(path)
+    m = re.match(r'([0-9]+)', basename)
+    return split_digits(dirname), int(m[1]) if m else 0, split_digits(basename)
+
+
+def parse_int(value):
+    m = re.match(r'\s*([0-9]+)', str(value))
+    return int(m[1]) if m else 0
 
 
 def get_socket(path):
@@ -108,10 +308,10 @@ def relpath(path):
     elif path.startswith(filelist.path):
         return path[len(filelist.path):].lstrip('/')
     else:
-        return os.path.relpath(path)
+        return os.path.relpath(path, filelist.path)
 
 
-@contextmanager
+@contextlib.contextmanager
 def enable_ctrl_keys():
     fd = sys.stdin.fileno()
     old = termios.tcgetattr(fd)
@@ -137,23 +337,304 @@ def listdir(path):
                         entry.path,
                         get_ext(entry.name),
                         entry.is_dir(follow_symlinks=False),
+                        entry.is_symlink(),
                     )
     except OSError:
         pass
 
 
+def read_dir(path):
+    return list(listdir(path))
+
+
+def enter_dir(path):
+    # unlike read_dir, fail if the directory cannot be opened
+    os.scandir(path).close()
+    return read_dir(path)
+
+
+class Filesystem:
+    """Run filesystem calls in worker threads with a deadline.
+
+    Access to a stale network mount can block in uninterruptible I/O. By only
+    waiting for a limited time the UI stays responsive. Results that arrive
+    after the deadline are passed to a callback on the main thread.
+    """
+
+    def __init__(self):
+        self.tasks = queue.SimpleQueue()
+        self.results = queue.SimpleQueue()
+        self.unreachable = set()
+        self.idle = 0
+        self.lock = threading.Lock()
+        self.wake_in, self.wake_out = os.pipe2(os.O_NONBLOCK)
+
+    def work(self):
+        while True:
+            future, fn, path = self.tasks.get()
+            try:
+                future.set_result(fn(path))
+            except Exception as e:  # noqa: BLE001
+                future.set_exception(e)
+            with self.lock:
+                self.idle += 1
+
+    def submit(self, fn, path):
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.idle:
+                self.idle -= 1
+            else:
+                # all workers might be stuck, so start a new one
+                threading.Thread(target=self.work, daemon=True).start()
+        self.tasks.put((future, fn, path))
+        return future
+
+    def call(self, fn, path, *, callback=None, timeout=FS_TIMEOUT):
+        future = self.submit(fn, path)
+        try:
+            result = future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.unreachable.add(path)
+            future.add_done_callback(
+                lambda f: self.deliver(f, path, callback)
+            )
+            raise TimeoutError(path) from None
+        self.unreachable.discard(path)
+        return result
+
+    def call_later(self, fn, path, callback):
+        future = self.submit(fn, path)
+        future.add_done_callback(lambda f: self.deliver(f, path, callback))
+
+    def deliver(self, future, path, callback):
+        # may be called from a worker thread
+        self.results.put((future, path, callback))
+        with contextlib.suppress(BlockingIOError):
+            os.write(self.wake_out, b'.')
+
+    def on_wake(self, _fileobj):
+        os.read(self.wake_in, 1024)
+        while not self.results.empty():
+            future, path, callback = self.results.get()
+            self.unreachable.discard(path)
+            if callback and not future.exception():
+                callback(future.result())
+
+
+def isdir(path, callback=None):
+    try:
+        return fs.call(os.path.isdir, path, callback=callback)
+    except TimeoutError:
+        return None
+
+
+def get_cache_dir():
+    return os.path.join(
+        os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+        'cplay-ng',
+    )
+
+
+def read_tags(path):
+    tags = {}
+    if mutagen:
+        try:
+            f = mutagen.File(path, easy=True)
+        except Exception:  # noqa: BLE001
+            f = None
+        if f and f.tags:
+            for key in ['artist', 'album', 'genre', 'title', 'tracknumber']:
+                if values := f.tags.get(key):
+                    tags[key] = values[0]
+
+    # fall back to the common artist/album/track layout
+    album_dir = os.path.dirname(path)
+    tags.setdefault('album', os.path.basename(album_dir))
+    tags.setdefault('artist', os.path.basename(os.path.dirname(album_dir)))
+    tags.setdefault('genre', '')
+    tags.setdefault('title', os.path.splitext(os.path.basename(path))[0])
+    # like directory_key, use the leading number of the file name
+    tags['tracknumber'] = parse_int(
+        tags.get('tracknumber') or os.path.basename(path)
+    )
+    return tags
+
+
+class Library:
+    """Metadata index of all audio files below a directory.
+
+    The index is stored in sqlite and updated incrementally in a background
+    thread: only files with a changed mtime are read again.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        digest = hashlib.md5(root.encode()).hexdigest()
+        self.path = os.path.join(get_cache_dir(), f'library-{digest}.sqlite')
+        self.version = 0
+        self.updating = False
+        self.count = 0
+        self._db = None
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = sqlite3.connect(self.path)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(LIBRARY_SCHEMA)
+        return db
+
+    @property
+    def db(self):
+        if not self._db:
+            self._db = self.connect()
+        return self._db
+
+    def query(self, sql, args=()):
+        return [row[0] for row in self.db.execute(sql, args)]
+
+    def walk(self, path, failed):
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.name[0] == '.':
+                        continue
+                    elif entry.is_dir(follow_symlinks=False):
+                        yield from self.walk(entry.path, failed)
+                    elif get_ext(entry.name) in AUDIO_EXTENSIONS:
+                        yield entry.path, entry.stat().st_mtime
+        except OSError:
+            # e.g. a stale mount, the files below might still exist
+            failed.append(path)
+
+    def update(self, root):
+        # runs in a worker thread, so it needs its own connection
+        db = self.connect()
+        try:
+            db.execute('CREATE TEMP TABLE seen (path TEXT PRIMARY KEY)')
+            changed = False
+            failed = []
+            for i, (path, mtime) in enumerate(self.walk(root, failed), 1):
+                db.execute('INSERT OR IGNORE INTO seen VALUES (?)', (path,))
+                row = db.execute(
+                    'SELECT mtime FROM tracks WHERE path = ?', (path,)
+                ).fetchone()
+                if not row or row[0] != mtime:
+                    tags = read_tags(path)
+                    # `added` is only set on insert, so it keeps the time
+                    # the file was first indexed
+                    db.execute(
+                        'INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                        'ON CONFLICT (path) DO UPDATE SET '
+                        'mtime = excluded.mtime, artist = excluded.artist, '
+                        'album = excluded.album, genre = excluded.genre, '
+                        'tracknumber = excluded.tracknumber, '
+                        'title = excluded.title',
+                        (
+                            path, mtime, time.time(),
+                            tags['artist'], tags['album'],
+                            tags['genre'], tags['tracknumber'], tags['title'],
+                        ),
+                    )
+                    changed = True
+                self.count = i
+                if changed and i % LIBRARY_BATCH == 0:
+                    db.commit()
+                    self.version += 1
+                    changed = False
+            # keep the tracks below directories that could not be listed
+            db.execute('CREATE TEMP TABLE failed (path TEXT PRIMARY KEY)')
+            db.executemany(
+                'INSERT OR IGNORE INTO failed VALUES (?)',
+                [(path,) for path in failed],
+            )
+            db.execute(
+                'DELETE FROM tracks WHERE path NOT IN (SELECT path FROM seen) '
+                'AND NOT EXISTS (SELECT 1 FROM failed WHERE '
+                'substr(tracks.path, 1, length(failed.path) + 1) '
+                "= failed.path || '/')"
+            )
+            db.commit()
+        finally:
+            db.close()
+            self.version += 1
+            self.updating = False
+
+    def start_update(self):
+        if not self.updating:
+            self.updating = True
+            self.count = 0
+            fs.submit(self.update, self.root)
+
+
+class Query(collections.abc.Sequence):
+    """Rows of a library query that are fetched page by page."""
+
+    def __init__(self, library, sql, args, order):
+        self.library = library
+        self.sql = sql
+        self.args = args
+        self.order = order
+        self._version = None
+
+    def _check_version(self):
+        if self._version != self.library.version:
+            self._version = self.library.version
+            self._len = None
+            self._pages = {}
+
+    def __len__(self):
+        self._check_version()
+        if self._len is None:
+            self._len = self.library.query(
+                f'SELECT COUNT(*) FROM ({self.sql})', self.args
+            )[0]
+        return self._len
+
+    def get_page(self, n):
+        self._check_version()
+        if n not in self._pages:
+            if len(self._pages) > 100:
+                self._pages = {}
+            self._pages[n] = self.library.query(
+                f'{self.sql} ORDER BY {self.order} LIMIT ? OFFSET ?',
+                (*self.args, LIBRARY_PAGE, n * LIBRARY_PAGE),
+            )
+        return self._pages[n]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        page = self.get_page(i // LIBRARY_PAGE)
+        try:
+            return page[i % LIBRARY_PAGE]
+        except IndexError:
+            # the index has changed in the meantime
+            return ''
+
+
 class Player:
     def __init__(self):
         self.path = None
         self.position = 0
         self.length = 0
         self.metadata = None
+        self.tags = {}
         self._seek_step = 0
         self._seek_timeout = None
         self.is_playing = False
         self._playing = 0
         self._buffer = b''
+        self._proc = None
+        self.socket = None
+        self._load_time = None
+        self.startup = None
 
+    def start(self, *, detach=False):
         self.socket_path = '%s/mpv-cplay-%i.sock' % (
             os.getenv('XDG_RUNTIME_DIR', '/tmp'), os.getpid()
         )
@@ -168,6 +649,8 @@ class Player:
             stdin=subprocess.DEVNULL,
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
+            # do not receive the hangup when the terminal is closed
+            start_new_session=detach,
         )
         self.socket = get_socket(self.socket_path)
 
@@ -187,8 +670,17 @@ class Player:
         elif data.get('event') == 'property-change' and data['id'] == 2:
             if data.get('data') is not None:
                 self.length = data['data']
+                self.tags.setdefault(self.path, {})['duration'] = self.length
         elif data.get('event') == 'property-change' and data['id'] == 3:
             self.metadata = data.get('data')
+            if self.metadata:
+                tags = {k.casefold(): v for k, v in self.metadata.items()}
+                self.tags.setdefault(self.path, {}).update(tags)
+        elif data.get('event') == 'playback-restart':
+            if self._load_time is not None:
+                self.startup = time.monotonic() - self._load_time
+                self._load_time = None
+                prefetcher.record(self.path, self.startup)
         elif data.get('event') == 'end-file':
             self._playing -= 1
 
@@ -238,6 +730,8 @@ class Player:
             self.position = 0
         self.length = 0
         self._seek_step = 0
+        self._load_time = time.monotonic() if self.path else None
+        self.startup = None
         self._play()
 
     def toggle(self):
@@ -269,8 +763,83 @@ class Player:
         return self.is_playing and self._playing == 0
 
     def cleanup(self):
-        self._proc.terminate()
-        os.remove(self.socket_path)
+        if self._proc:
+            self._proc.terminate()
+            os.remove(self.socket_path)
+
+
+class Prefetcher:
+    """Read the beginning of upcoming tracks in a background thread.
+
+    This moves cold I/O (e.g. on spinning disks or network mounts) out of
+    the transition between tracks. Startup times of warm and cold tracks
+    are recorded so the effect can be compared.
+    """
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.requested = set()
+        # bytes that were read ahead for each track
+        self.warmed = {}
+        self.lock = threading.Lock()
+        self.startup = {
+            True: collections.deque(maxlen=PREFETCH_SAMPLES),
+            False: collections.deque(maxlen=PREFETCH_SAMPLES),
+        }
+        self._thread = None
+
+    def update(self, paths, current):
+        if not self._thread:
+            self._thread = threading.Thread(target=self.work, daemon=True)
+            self._thread.start()
+
+        for path in paths:
+            if path not in self.requested and not path.startswith('http'):
+                self.queue.put(path)
+
+        keep = {*paths, current}
+        self.requested = {p for p in self.requested if p in keep}
+        self.requested.update(paths)
+        with self.lock:
+            for path in list(self.warmed):
+                if path not in keep:
+                    del self.warmed[path]
+
+    def record(self, path, startup):
+        self.startup[path in self.warmed].append(startup)
+
+    def get_average(self, warm):
+        samples = self.startup[warm]
+        return sum(samples) / len(samples) if samples else None
+
+    def warm(self, path, size):
+        with open(path, 'rb', buffering=0) as fh:
+            size = min(size, os.fstat(fh.fileno()).st_size)
+            if hasattr(os, 'posix_fadvise'):
+                # let the kernel fill the page cache without copying the data
+                os.posix_fadvise(fh.fileno(), 0, size, os.POSIX_FADV_WILLNEED)
+            else:
+                remaining = size
+                while remaining > 0 and (
+                    chunk := fh.read(min(remaining, 2**20))
+                ):
+                    remaining -= len(chunk)
+        return size
+
+    def work(self):
+        while True:
+            path = self.queue.get()
+            with self.lock:
+                remaining = PREFETCH_BUDGET - sum(self.warmed.values())
+            size = min(remaining, PREFETCH_BUDGET // PREFETCH_AHEAD)
+            if size <= 0:
+                continue
+            try:
+                size = self.warm(path, size)
+            except OSError:
+                continue
+            with self.lock:
+                self.warmed[path] = size
 
 
 class Input:
@@ -316,6 +885,10 @@ class List:
         self.cursor = 0
         self.active = -1
         self.search_str = ''
+        self.search_results = []
+        self.search_index = 0
+        self.search_job = None
+        self._matcher = None
 
     @property
     def rows(self):
@@ -333,18 +906,68 @@ class List:
     def move_cursor(self, diff):
         self.set_cursor(self.cursor + diff)
 
-    def search(self, q, diff=1, offset=0):
-        self.search_str = q
-        for i in range(len(self.items)):
-            pos = (self.cursor + (i + offset) * diff) % len(self.items)
-            if str_match(q, self.format_item(self.items[pos])):
-                self.set_cursor(pos)
-                return True
-        return False
+    def search_strings(self):
+        return [self.format_item(item) for item in self.items]
+
+    def get_matcher(self):
+        if (
+            not self._matcher
+            or self._matcher[0] is not self.items
+            or len(self._matcher[1]) != len(self.items)
+        ):
+            self._matcher = (self.items, Matcher(self.search_strings()))
+        return self._matcher[1]
+
+    def search(self, q):
+        self.search_str, prev = q, self.search_str
+        self.search_results = []
+        self.search_index = 0
+        if q:
+            matcher = self.get_matcher()
+            job = self.search_job
+            if (
+                job
+                and job.done
+                and job.strings is matcher.strings
+                and prev
+                and q.startswith(prev)
+            ):
+                # narrow down the previous matches
+                self.search_job = matcher.start(q, job.matches)
+            else:
+                self.search_job = matcher.start(q)
+            self.step_search()
+        else:
+            self.search_job = None
+
+    @property
+    def searching(self):
+        return self.search_job is not None and not self.search_job.done
+
+    def step_search(self):
+        # subclasses extend `searching`, so check the job directly
+        if self.search_job is not None and not self.search_job.done:
+            self.search_job.step()
+            self.search_results = self.search_job.results()
+            # follow the best match until the user moves on to the next one
+            if self.search_results and self.search_index == 0:
+                self.set_cursor(self.search_results[0])
+
+    def next_search_result(self, diff):
+        if self._matcher and len(self._matcher[1]) != len(self.items):
+            self.search(self.search_str)
+            return
+        if self.search_results:
+            self.search_index += diff
+            self.search_index %= len(self.search_results)
+            self.set_cursor(self.search_results[self.search_index])
 
     def format_item(self, item):
         return relpath(item)
 
+    def get_marker(self, item):
+        return ' '
+
     def render(self):
         items = self.items[self.position:self.position + self.rows]
         for i, item in enumerate(items):
@@ -354,7 +977,8 @@ class List:
             if self.position + i == self.active:
                 attr |= curses.A_BOLD
             s_item = self.format_item(item)
-            s_item = space_between(f'  {s_item}', '', app.cols)
+            marker = self.get_marker(item)
+            s_item = space_between(f'{marker} {s_item}', '', app.cols)
             yield (s_item, attr)
         for _i in range(max(0, self.rows - len(items))):
             yield ''
@@ -375,11 +999,9 @@ class List:
         elif key == '/':
             app.input.start('/', on_input=self.search)
         elif key == ']':
-            if self.search_str:
-                self.search(self.search_str, 1, 1)
+            self.next_search_result(1)
         elif key == '[':
-            if self.search_str:
-                self.search(self.search_str, -1, 1)
+            self.next_search_result(-1)
         else:
             return False
         return True
@@ -409,12 +1031,22 @@ class Filelist(List):
         super().__init__()
         self.path = None
         self.rsearch_str = ''
-        self.set_path(os.getcwd(), fail_silently=False)
+        self.search_cache = None
+        self.scanning = False
+        self.filter_job = None
+        self._search_matcher = None
+        self.all_items = []
 
     def get_title(self):
         title = f'Filelist: {self.path.rstrip("/")}/'
         if self.rsearch_str:
             title += f'search "{self.rsearch_str}"/'
+        if self.path in fs.unreachable:
+            title += ' [unreachable]'
+        elif self.scanning:
+            title += ' [scanning]'
+        elif self.searching:
+            title += ' [searching]'
         return title
 
     def format_item(self, item):
@@ -424,23 +1056,62 @@ class Filelist(List):
             s += '/'
         return s
 
+    def get_marker(self, item):
+        if item in fs.unreachable:
+            return '!'
+        elif item in playlist.index:
+            return '+'
+        else:
+            return ' '
+
     def set_path(self, path, *, prev=None, refresh=False, fail_silently=True):
+        try:
+            entries = fs.call(
+                enter_dir,
+                path,
+                callback=lambda entries: self.on_late_entries(
+                    path, entries, prev
+                ),
+            )
+        except TimeoutError:
+            entries = []
+        except Exception:
+            if fail_silently:
+                return
+            raise
+
         if path != self.path:
-            try:
-                os.chdir(path)
-            except Exception:
-                if fail_silently:
-                    return
-                raise
             self.path = path
             relpath.cache_clear()
-            self.search_cache = []
+            self.search_cache = None
+            self.scanning = False
         elif refresh:
-            self.search_cache = []
-        self.all_items = []
+            self.search_cache = None
         self.rsearch_str = ''
+        self.filter_job = None
+        self.set_entries(entries, prev)
+
+    def restore(self, path, items, cursor):
+        # show the listing from the last session and refresh it later
+        self.path = path
+        self.all_items = items
+        self.items = self.all_items
+        self.search_cache = None
+        self.set_cursor(cursor)
+        prev = self.items[self.cursor] if self.items else None
+        fs.call_later(
+            enter_dir,
+            path,
+            lambda entries: self.on_late_entries(path, entries, prev),
+        )
+
+    def on_late_entries(self, path, entries, prev):
+        if path == self.path and not self.rsearch_str:
+            self.set_entries(entries, prev)
 
-        for p, ext, is_dir in listdir(path):
+    def set_entries(self, entries, prev):
+        self.all_items = []
+        for p, ext, is_dir, _is_link in entries:
             if is_dir or ext == 'm3u' or ext in AUDIO_EXTENSIONS:
                 self.all_items.append(p)
 
@@ -454,7 +1125,7 @@ class Filelist(List):
 
     def build_search_cache(self, root):
         results = []
-        for path, ext, is_dir in listdir(root):
+        for path, ext, is_dir, _is_link in listdir(root):
             if is_dir:
                 children = self.build_search_cache(path)
                 if children:
@@ -464,29 +1135,82 @@ class Filelist(List):
                 results.append(path)
         return results
 
+    def on_late_search_cache(self, path, results):
+        if path == self.path and self.scanning:
+            self.scanning = False
+            self.search_cache = results
+            if self.rsearch_str:
+                query = self.rsearch_str
+                self.rsearch_str = ''
+                self.filter(query)
+
+    def get_search_matcher(self):
+        if (
+            not self._search_matcher
+            or self._search_matcher[0] is not self.search_cache
+        ):
+            strings = [
+                self.format_item(path) for path in self.search_cache or []
+            ]
+            self._search_matcher = (self.search_cache, Matcher(strings))
+        return self._search_matcher[1]
+
     def filter(self, query):
-        if not self.search_cache:
-            self.search_cache = self.build_search_cache(self.path)
+        if self.search_cache is None and not self.scanning:
+            # walking a whole tree can take longer than the deadline even on
+            # a healthy disk, so the results are always delivered later
+            path = self.path
+            self.scanning = True
+            fs.call_later(
+                self.build_search_cache,
+                path,
+                lambda results: self.on_late_search_cache(path, results),
+            )
 
+        self.rsearch_str, prev = query, self.rsearch_str
         if query:
-            if self.rsearch_str and query.startswith(self.rsearch_str):
-                base = self.items
+            matcher = self.get_search_matcher()
+            job = self.filter_job
+            if (
+                job
+                and job.done
+                and job.strings is matcher.strings
+                and prev
+                and query.startswith(prev)
+            ):
+                # narrow down the previous matches
+                self.filter_job = matcher.start(query, job.matches)
             else:
-                base = self.search_cache
-
-            self.items = []
-            for path in base:
-                if str_match(query, self.format_item(path)):
-                    self.items.append(path)
+                self.filter_job = matcher.start(query)
+            self.step_search()
         else:
+            self.filter_job = None
             self.items = self.all_items
+            self.set_cursor(self.cursor)
+
+    @property
+    def filtering(self):
+        return self.filter_job is not None and not self.filter_job.done
 
-        self.rsearch_str = query
-        self.set_cursor(self.cursor)
+    @property
+    def searching(self):
+        return super().searching or self.filtering
+
+    def step_search(self):
+        super().step_search()
+        if self.filtering:
+            self.filter_job.step()
+            self.items = [
+                self.search_cache[i] for i in self.filter_job.results()
+            ]
+            self.set_cursor(self.cursor)
 
     def activate(self, item):
         ext = item.rsplit('.', 1)[-1]
-        if os.path.isdir(item):
+        is_dir = isdir(item)
+        if is_dir is None:
+            return
+        elif is_dir:
             self.set_path(item)
         elif ext in AUDIO_EXTENSIONS:
             playlist.active = -1
@@ -507,6 +1231,9 @@ class Filelist(List):
                 self.activate(self.items[self.cursor])
         elif key == 'r':
             self.set_path(self.path, refresh=True)
+        elif key == 'v':
+            librarylist.open(self.path)
+            app.tabs[app.tabs.index(self)] = librarylist
         elif key == curses.KEY_BACKSPACE:
             if self.rsearch_str:
                 self.set_path(self.path)
@@ -517,12 +1244,151 @@ class Filelist(List):
         return True
 
 
+class LibraryList(List):
+    def __init__(self):
+        super().__init__()
+        self.library = None
+        self.view = None
+        self.args = []
+        self.cursors = []
+        self.items = list(LIBRARY_VIEWS)
+
+    @property
+    def updating(self):
+        return self.library is not None and self.library.updating
+
+    @property
+    def column(self):
+        if self.view:
+            return LIBRARY_VIEWS[self.view][len(self.args)]
+
+    def get_title(self):
+        title = 'Library'
+        if self.view:
+            title += ': ' + ' / '.join([self.view, *self.args])
+        if self.updating:
+            title += f' [indexing {self.library.count}]'
+        return title
+
+    def format_item(self, item):
+        if self.column == 'path':
+            return super().format_item(item)
+        elif self.view:
+            return item or '(unknown)'
+        else:
+            return item
+
+    def search_strings(self):
+        if not self.view:
+            return super().search_strings()
+        # fetch all rows at once instead of page by page
+        rows = self.library.query(
+            f'{self.items.sql} ORDER BY {self.items.order}', self.items.args
+        )
+        return [self.format_item(row) for row in rows]
+
+    def open(self, root):
+        if not self.library or self.library.root != root:
+            self.library = Library(root)
+            self.view = None
+            self.args = []
+            self.cursors = []
+            self.refresh()
+        self.library.start_update()
+
+    def where(self, view, args):
+        columns = LIBRARY_VIEWS[view][:len(args)]
+        return ' AND '.join(f'{c} = ?' for c in columns) or '1'
+
+    def refresh(self):
+        if not self.view:
+            self.items = list(LIBRARY_VIEWS)
+            return
+        where = self.where(self.view, self.args)
+        if self.column != 'path':
+            sql = f'SELECT DISTINCT {self.column} FROM tracks WHERE {where}'
+            order = self.column
+        elif self.view == 'Recently added':
+            sql = f'SELECT path FROM tracks WHERE {where}'
+            order = 'added DESC'
+        else:
+            sql = f'SELECT path FROM tracks WHERE {where}'
+            order = 'tracknumber, path'
+        self.items = Query(self.library, sql, self.args, order)
+
+    def get_contents(self, item):
+        if self.column == 'path':
+            return [item]
+        elif self.view:
+            view, args = self.view, [*self.args, item]
+        else:
+            view, args = item, []
+        if view == 'Recently added':
+            order = 'added DESC'
+        else:
+            order = 'artist, album, tracknumber, path'
+        return self.library.query(
+            f'SELECT path FROM tracks WHERE {self.where(view, args)} '
+            f'ORDER BY {order}',
+            args,
+        )
+
+    def enter(self, item):
+        self.cursors.append(self.cursor)
+        if self.view:
+            self.args.append(item)
+        else:
+            self.view = item
+        self.refresh()
+        self.set_cursor(0)
+
+    def leave(self):
+        if not self.view:
+            return
+        if self.args:
+            self.args.pop()
+        else:
+            self.view = None
+        self.refresh()
+        self.set_cursor(self.cursors.pop())
+
+    def process_key(self, key):
+        if key == 'a':
+            if self.items:
+                playlist.extend(self.get_contents(self.items[self.cursor]))
+                self.move_cursor(1)
+        elif key == '\n':
+            if not self.items:
+                pass
+            elif self.column == 'path':
+                playlist.active = -1
+                player.play(self.items[self.cursor])
+            else:
+                self.enter(self.items[self.cursor])
+        elif key == curses.KEY_BACKSPACE:
+            self.leave()
+        elif key == 'r':
+            self.library.start_update()
+        elif key == 'v':
+            app.tabs[app.tabs.index(self)] = filelist
+        else:
+            return super().process_key(key)
+        return True
+
+
 class Playlist(List):
     def __init__(self):
         super().__init__()
         self.repeat = False
         self.random = False
+        self.unique = False
+        self.sort_mode = SORT_MODES[0]
         self._played = set()
+        self._index = {}
+        self._plan = []
+        self._keys = {}
+        self.jobs = collections.deque()
+        self.added = 0
         self.path = None
         self.items_written = []
 
@@ -536,36 +1402,113 @@ class Playlist(List):
             title += ' [repeat all]'
         if self.random:
             title += ' [random]'
+        if self.unique:
+            title += ' [unique]'
+        if self.sort_mode != SORT_MODES[0]:
+            title += f' [sort by {self.sort_mode}]'
         return title
 
+    @property
+    def index(self):
+        # maps each path to its positions in the playlist. Appending keeps
+        # it up to date, all other modifications invalidate it.
+        if self._index is None:
+            self._index = {}
+            for i, item in enumerate(self.items):
+                self._index.setdefault(item, []).append(i)
+        return self._index
+
     def clear(self):
         self.items = []
         self.position = 0
         self.cursor = 0
         self.active = -1
         self._played = set()
+        self._index = {}
+        self._plan = []
+        self._keys = {}
+        self.cancel()
+        session.cancel()
 
     def reorder(self, fn):
+        # reorder indices instead of items so that duplicate entries keep
+        # their identity
         if not self.items:
             return
-        cursor_item = self.items[self.cursor]
-        try:
-            active_item = self.items[self.active]
-        except IndexError:
-            active_item = None
-        fn()
-        self.set_cursor(self.items.index(cursor_item))
-        if active_item:
-            self.active = self.items.index(active_item)
+        order = list(range(len(self.items)))
+        fn(order)
+        new_index = [0] * len(order)
+        for new, old in enumerate(order):
+            new_index[old] = new
+        self.items = [self.items[i] for i in order]
+        self._index = None
+        self._plan = []
+        self.set_cursor(new_index[self.cursor])
+        if 0 <= self.active < len(new_index):
+            self.active = new_index[self.active]
+        self._played = {
+            new_index[i] for i in self._played if 0 <= i < len(new_index)
+        }
 
     def shuffle(self):
-        self.reorder(lambda: random.shuffle(self.items))
+        self.reorder(random.shuffle)
+
+    def cached_key(self, fn, path):
+        # the keys of a path never change, so keep them for the next sort
+        # until the playlist is cleared
+        if (fn, path) not in self._keys:
+            self._keys[fn, path] = fn(path)
+        return self._keys[fn, path]
+
+    def sort_key(self, path):
+        if self.sort_mode == 'directory':
+            return self.cached_key(directory_key, path)
+        tags = player.tags.get(path, {})
+        if self.sort_mode == 'tags':
+            return (
+                'artist' not in tags,
+                str(tags.get('artist', '')).casefold(),
+                str(tags.get('album', '')).casefold(),
+                parse_int(tags.get('track', tags.get('tracknumber', ''))),
+                self.cached_key(natural_key, path),
+            )
+        elif self.sort_mode == 'duration':
+            return (
+                'duration' not in tags,
+                tags.get('duration', 0),
+                self.cached_key(natural_key, path),
+            )
+        else:
+            return self.cached_key(natural_key, path)
 
     def sort(self):
-        self.reorder(lambda: self.items.sort())
+        keys = [self.sort_key(item) for item in self.items]
+        self.reorder(lambda order: order.sort(key=keys.__getitem__))
+
+    def cycle_sort_mode(self):
+        i = SORT_MODES.index(self.sort_mode)
+        self.sort_mode = SORT_MODES[(i + 1) % len(SORT_MODES)]
+        self.sort()
+
+    def dedupe(self):
+        if not self.items:
+            return
+        first = {path: positions[0] for path, positions in self.index.items()}
+        keep = sorted(first.values())
+        new_index = {old: new for new, old in enumerate(keep)}
+        cursor = new_index[first[self.items[self.cursor]]]
+        if 0 <= self.active < len(self.items):
+            self.active = new_index[first[self.items[self.active]]]
+        self._played = {new_index[i] for i in self._played if i in new_index}
+        self.items = [self.items[i] for i in keep]
+        self._index = None
+        self._plan = []
+        self.set_cursor(cursor)
 
     def remove_item(self):
         self.items.pop(self.cursor)
+        self._index = None
+        self._plan = []
 
         if self.active == self.cursor:
             self.active = -1
@@ -586,17 +1529,37 @@ class Playlist(List):
 
         item = self.items.pop(self.cursor)
         self.items.insert(new_cursor, item)
+        self._index = None
+        self._plan = []
         self.set_cursor(new_cursor)
 
+    def plan(self, n):
+        # choose the next random tracks in advance so they can be prefetched
+        if len(self._plan) < n:
+            left = set(range(len(self.items)))
+            left.difference_update(self._played, self._plan, [self.active])
+            k = min(n - len(self._plan), len(left))
+            self._plan += random.sample(list(left), k)
+
+    def peek(self, n):
+        if self.random:
+            self.plan(n)
+            indices = self._plan[:n]
+        else:
+            indices = range(self.active + 1, self.active + 1 + n)
+            if self.repeat and self.items:
+                indices = [i % len(self.items) for i in indices]
+        return [self.items[i] for i in indices if 0 <= i < len(self.items)]
+
     def next(self):
         if not self.items:
             return
 
         if self.random:
             self._played.add(self.active)
-            left = set(range(len(self.items))).difference(self._played)
-            if left:
-                self.active = random.choice(list(left))
+            self.plan(1)
+            if self._plan:
+                self.active = self._plan.pop(0)
             else:
                 self._played = set()
                 if self.repeat:
@@ -613,11 +1576,51 @@ class Playlist(List):
         except IndexError:
             self.active = -1
 
+    def iter_dir(self, path):
+        jobs = self.jobs
+
+        def on_late_entries(entries):
+            # the job might have been cancelled in the meantime
+            if jobs is self.jobs:
+                jobs.append(self.iter_entries(entries))
+
+        try:
+            entries = fs.call(read_dir, path, callback=on_late_entries)
+        except TimeoutError:
+            return
+        yield from self.iter_entries(entries)
+
+    def iter_entries(self, entries):
+        # use the file type from scandir instead of calling stat on every
+        # entry. Only symlinks need an extra check.
+        for p, ext, is_dir, is_link in entries:
+            if ext in AUDIO_EXTENSIONS:
+                yield self.append(p)
+            elif is_dir or (is_link and isdir(p)):
+                yield from self.iter_dir(p)
+            else:
+                yield 0
+
+    def add_job(self, job):
+        if not self.jobs:
+            self.added = 0
+        self.jobs.append(job)
+
     def add_dir(self, path):
-        count = 0
-        for p, _ext, _is_dir in listdir(path):
-            count += self.add(p, recursive=True)
-        return count
+        self.add_job(self.iter_dir(path))
+        return True
+
+    def step(self):
+        for _ in range(ADD_BATCH):
+            if not self.jobs:
+                break
+            try:
+                self.added += next(self.jobs[0])
+            except StopIteration:
+                self.jobs.popleft()
+
+    def cancel(self):
+        self.jobs = collections.deque()
 
     def add_playlist(self, path):
         count = 0
@@ -629,19 +1632,39 @@ class Playlist(List):
                     continue
                 if not re.match(r'^(/|https?://)', line):
                     line = os.path.join(dirname, line)
-                self.items.append(line)
-                count += 1
+                count += self.append(line)
         return count
 
-    def add(self, path, *, recursive=False):
+    def extend(self, paths):
+        if self.unique:
+            paths = [p for p in dict.fromkeys(paths) if p not in self.index]
+        index = self.index
+        for i, path in enumerate(paths, len(self.items)):
+            index.setdefault(path, []).append(i)
+        self.items.extend(paths)
+        return len(paths)
+
+    def append(self, path):
+        if self.unique and path in self.index:
+            return 0
+        self.index.setdefault(path, []).append(len(self.items))
+        self.items.append(path)
+        return 1
+
+    def add(self, path, *, is_dir=None):
         ext = path.rsplit('.', 1)[-1]
-        if os.path.isdir(path):
+        if is_dir is None:
+            is_dir = isdir(
+                path, callback=lambda is_dir: self.add(path, is_dir=is_dir)
+            )
+        if is_dir is None:
+            return 0
+        elif is_dir:
             return self.add_dir(path)
-        elif ext == 'm3u' and not recursive:
+        elif ext == 'm3u':
             return self.add_playlist(path)
         elif ext in AUDIO_EXTENSIONS:
-            self.items.append(path)
-            return 1
+            return self.append(path)
         else:
             return 0
 
@@ -652,6 +1675,9 @@ class Playlist(List):
         self.items_written = self.items.copy()
 
     def write(self, path):
+        # the process does not change its working directory, so resolve
+        # relative paths against the directory that is shown
+        path = os.path.join(filelist.path, os.path.expanduser(path))
         try:
             with open(path, 'w') as fh:
                 for item in self.items:
@@ -685,6 +1711,12 @@ class Playlist(List):
             self.shuffle()
         elif key == 'S':
             self.sort()
+        elif key == 'o':
+            self.cycle_sort_mode()
+        elif key == 'u':
+            self.unique = not self.unique
+        elif key == 'U':
+            self.dedupe()
         elif key == 'r':
             self.repeat = not self.repeat
         elif key == 'R':
@@ -700,24 +1732,324 @@ class Playlist(List):
         return True
 
 
-class Application:
+def get_state_dir():
+    return os.path.join(
+        os.getenv('XDG_STATE_HOME', os.path.expanduser('~/.local/state')),
+        'cplay-ng',
+    )
+
+
+@contextlib.contextmanager
+def atomic_write(path):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as fh:
+        yield fh
+    os.replace(tmp, path)
+
+
+class Session:
+    """Snapshot of the state that is restored on the next start.
+
+    The small state is stored as JSON, the playlist items as a separate m3u
+    file that is only rewritten when they change. On restore, the playlist
+    is loaded in the background so the UI is usable immediately.
+    """
+
+    def __init__(self):
+        self.dir = get_state_dir()
+        self.items_saved = []
+        self.job = None
+        self.restored = None
+        self.last_save = time.monotonic()
+
+    @property
+    def restoring(self):
+        return self.job is not None
+
+    @property
+    def state_path(self):
+        return os.path.join(self.dir, 'session.json')
+
+    @property
+    def playlist_path(self):
+        return os.path.join(self.dir, 'session.m3u')
+
+    def get_playlist_state(self):
+        # do not overwrite the snapshot with a partially restored playlist
+        if self.restoring:
+            return self.restored
+        if playlist.items != self.items_saved:
+            with atomic_write(self.playlist_path) as fh:
+                fh.writelines(f'{item}\n' for item in playlist.items)
+            self.items_saved = playlist.items.copy()
+        return {
+            'path': playlist.path,
+            'written': playlist.items == playlist.items_written,
+            'active': playlist.active,
+            'cursor': playlist.cursor,
+            'repeat': playlist.repeat,
+            'random': playlist.random,
+            'unique': playlist.unique,
+            'sort_mode': playlist.sort_mode,
+            'played': sorted(playlist._played),
+        }
+
+    def save(self):
+        self.last_save = time.monotonic()
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            state = self.get_playlist_state()
+            with atomic_write(self.state_path) as fh:
+                json.dump({
+                    'player': {
+                        'path': player.path,
+                        'position': player.position,
+                    },
+                    'playlist': state,
+                    'filelist': {
+                        'path': filelist.path,
+                        'items': filelist.all_items,
+                        'cursor': filelist.cursor,
+                    },
+                }, fh, separators=(',', ':'))
+        except OSError:
+            pass
+
+    def tick(self):
+        if time.monotonic() - self.last_save > SESSION_INTERVAL:
+            self.save()
+
+    def step(self):
+        # separate from the playlist jobs so that Esc does not cancel it
+        for _ in range(ADD_BATCH):
+            if not self.job:
+                break
+            try:
+                next(self.job)
+            except StopIteration:
+                self.cancel()
+
+    def cancel(self):
+        self.job = None
+        self.restored = None
+
+    def iter_items(self, data):
+        try:
+            with open(self.playlist_path, errors='replace') as fh:
+                for line in fh:
+                    yield playlist.append(line.rstrip('\n'))
+        except OSError:
+            pass
+        self.items_saved = playlist.items.copy()
+        if data['path'] and data['written']:
+            playlist.items_written = playlist.items.copy()
+        playlist.set_cursor(data['cursor'])
+        # the items are already deduplicated if this was enabled before
+        playlist.unique = data['unique']
+
+    def parse(self, data):
+        # fill in defaults for missing fields, e.g. from an older version
+        player_data = data.get('player', {})
+        pl = data.get('playlist')
+        fl = data.get('filelist', {})
+        if pl is not None:
+            sort_mode = pl.get('sort_mode')
+            pl = {
+                'path': pl.get('path'),
+                'written': bool(pl.get('written')),
+                'active': int(pl.get('active', -1)),
+                'cursor': int(pl.get('cursor', 0)),
+                'repeat': bool(pl.get('repeat')),
+                'random': bool(pl.get('random')),
+                'unique': bool(pl.get('unique')),
+                'sort_mode': (
+                    sort_mode if sort_mode in SORT_MODES else SORT_MODES[0]
+                ),
+                'played': sorted(int(i) for i in pl.get('played', [])),
+            }
+        return {
+            'player': {
+                'path': player_data.get('path'),
+                'position': float(player_data.get('position', 0)),
+            },
+            'playlist': pl,
+            'filelist': {
+                'path': fl.get('path'),
+                'items': [str(item) for item in fl.get('items', [])],
+                'cursor': int(fl.get('cursor', 0)),
+            },
+        }
+
+    def restore(self):
+        try:
+            with open(self.state_path) as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            data = {}
+
+        try:
+            data = self.parse(data)
+        except (AttributeError, TypeError, ValueError):
+            # the snapshot is damaged, so start with a fresh session
+            data = self.parse({})
+
+        cwd = os.getcwd()
+        if data['filelist']['path'] == cwd:
+            filelist.restore(
+                cwd, data['filelist']['items'], data['filelist']['cursor']
+            )
+        else:
+            filelist.set_path(cwd, fail_silently=False)
+
+        if data['playlist'] is not None:
+            pl = data['playlist']
+            playlist.path = pl['path']
+            playlist.active = pl['active']
+            playlist.repeat = pl['repeat']
+            playlist.random = pl['random']
+            playlist.sort_mode = pl['sort_mode']
+            playlist._played = set(pl['played'])
+            self.job = self.iter_items(pl)
+            self.restored = pl
+
+        if data['player']['path']:
+            player.path = data['player']['path']
+            player.position = data['player']['position']
+
+
+class Screen:
     def __init__(self):
-        self.tabs = [filelist, playlist]
-        self.help = False
-        self.input = Input()
         self.old_lines = []
+        self.rows = 24
+        self.cols = 80
 
         # self-pipe to avoid concurrency issues with signal
         self.resize_in, self.resize_out = os.pipe2(os.O_NONBLOCK)
 
+    def on_sigwinch(self, *_args):
+        os.write(self.resize_out, b'.')
+
+    @contextlib.contextmanager
+    def open(self):
+        self.window = curses.initscr()
+        self.window.keypad(True)  # noqa: FBT003
+        curses.cbreak()
+        curses.noecho()
+        curses.meta(True)  # noqa: FBT003
+        curses.curs_set(0)
+
+        signal.signal(signal.SIGWINCH, self.on_sigwinch)
+
+        try:
+            with enable_ctrl_keys():
+                self.refresh_dimensions()
+                yield
+        finally:
+            curses.endwin()
+
     def refresh_dimensions(self):
-        self.rows, self.cols = self.screen.getmaxyx()
+        self.rows, self.cols = self.window.getmaxyx()
 
     def on_resize(self):
+        os.read(self.resize_in, 8)
         curses.endwin()
-        self.screen.refresh()
+        self.window.refresh()
         self.refresh_dimensions()
-        self.tab.set_cursor(app.tab.cursor)
+
+    def get_wch(self):
+        return self.window.get_wch()
+
+    def draw(self, lines, cursor, *, force=False):
+        # lines from a daemon may still have been rendered for another size
+        lines = lines[:self.rows]
+        cursor = min(cursor, self.rows - 1)
+        try:
+            for i, line in enumerate(lines):
+                if (
+                    not force
+                    and len(self.old_lines) > i
+                    and line == self.old_lines[i]
+                ):
+                    continue
+                self.window.move(i, 0)
+                self.window.clrtoeol()
+                if isinstance(line, str):
+                    self.window.insstr(i, 0, line, 0)
+                else:
+                    self.window.insstr(i, 0, *line)
+            # make sure cursor is in a meaningful position for a11y
+            self.window.move(cursor, 0)
+            self.window.refresh()
+        except curses.error:
+            pass
+        self.old_lines = lines
+
+
+class Connection:
+    def __init__(self, sock):
+        self.socket = sock
+        self.lines = []
+        self.cursor = 0
+        self.size = None
+        self.closed = False
+        self._buffer = b''
+        self._out = bytearray()
+
+    @property
+    def pending(self):
+        return len(self._out)
+
+    def send(self, data):
+        self._out += json.dumps(data).encode('utf-8') + b'\n'
+        self.flush()
+
+    def flush(self):
+        # works for both blocking and non-blocking sockets
+        while self._out:
+            try:
+                n = self.socket.send(self._out)
+            except BlockingIOError:
+                break
+            except OSError:
+                self.closed = True
+                self._out.clear()
+                break
+            del self._out[:n]
+
+    def recv(self):
+        """Return a list of messages or None if the connection is closed."""
+        try:
+            data = self.socket.recv(4096)
+        except BlockingIOError:
+            return []
+        except OSError:
+            data = b''
+        if not data:
+            return None
+        self._buffer += data
+        msgs = self._buffer.split(b'\n')
+        self._buffer = msgs.pop()
+        try:
+            return [
+                json.loads(msg.decode('utf-8', errors='replace'))
+                for msg in msgs
+            ]
+        except ValueError:
+            return None
+
+
+class Application:
+    def __init__(self):
+        self.tabs = [filelist, playlist]
+        self.help = False
+        self.input = Input()
+        self.screen = Screen()
+        self.rows = self.screen.rows
+        self.cols = self.screen.cols
+
+    def set_dimensions(self, rows, cols):
+        self.rows, self.cols = rows, cols
+        self.tab.set_cursor(self.tab.cursor)
 
     @property
     def tab(self):
@@ -726,6 +2058,10 @@ class Application:
         else:
             return self.tabs[0]
 
+    @property
+    def cursor_row(self):
+        return self.tab.cursor - self.tab.position + 2
+
     def toggle_tabs(self):
         self.tabs.append(self.tabs.pop(0))
 
@@ -742,10 +2078,24 @@ class Application:
 
         if self.input.active:
             status = f'{self.input.prompt}{self.input.str}█'
+        elif playlist.jobs:
+            status = f'Adding {playlist.added} files (Esc to cancel)'
+        elif session.restoring:
+            status = 'Restoring playlist'
         elif self.tab == helplist:
             status = f'cplay-ng {__version__}'
         elif player.is_playing:
             status = f'Playing {player.get_title()}'
+            if (
+                player.startup is not None
+                and player.path in prefetcher.warmed
+                and player.position < 5
+            ):
+                status += f' (prefetched, started in {player.startup:.2f}s'
+                cold = prefetcher.get_average(warm=False)
+                if cold is not None:
+                    status += f' vs. {cold:.2f}s cold'
+                status += ')'
         else:
             status = ''
 
@@ -756,27 +2106,10 @@ class Application:
         yield space_between(status, counter, self.cols)
 
     def render(self, *, force=False):
-        lines = list(self._render())
-        try:
-            for i, line in enumerate(lines):
-                if (
-                    not force
-                    and len(self.old_lines) > i
-                    and line == self.old_lines[i]
-                ):
-                    continue
-                self.screen.move(i, 0)
-                self.screen.clrtoeol()
-                if isinstance(line, str):
-                    self.screen.insstr(i, 0, line, 0)
-                else:
-                    self.screen.insstr(i, 0, *line)
-            # make sure cursor is in a meaningful position for a11y
-            self.screen.move(self.tab.cursor - self.tab.position + 2, 0)
-            self.screen.refresh()
-        except curses.error:
-            pass
-        self.old_lines = lines
+        self.screen.draw(list(self._render()), self.cursor_row, force=force)
+
+    def quit(self):
+        sys.exit(0)
 
     def process_key(self, key):  # noqa: C901
         if self.input.process_key(key):
@@ -793,9 +2126,13 @@ class Application:
             player.toggle()
         elif key == 'n':
             player.play(playlist.next())
+        elif key == chr(27) and playlist.jobs:
+            playlist.cancel()
         elif key == 'h':
             self.help = True
-        elif key in ['q', 'Q']:
+        elif key == 'q':
+            self.quit()
+        elif key == 'Q':
             sys.exit(0)
         elif key == '\t':
             app.toggle_tabs()
@@ -803,20 +2140,47 @@ class Application:
             return False
         return True
 
-    def run(self):
-        self.refresh_dimensions()
+    def on_key(self, _fileobj):
+        self.process_key(self.screen.get_wch())
+
+    def on_resize(self, _fileobj):
+        self.screen.on_resize()
+        self.set_dimensions(self.screen.rows, self.screen.cols)
+        self.render(force=True)
+
+    def register(self, sel):
+        sel.register(sys.stdin, selectors.EVENT_READ, self.on_key)
+        sel.register(
+            self.screen.resize_in, selectors.EVENT_READ, self.on_resize
+        )
+
+    def update(self):
         self.render()
 
+    def loop(self):
         with selectors.DefaultSelector() as sel:
-            sel.register(sys.stdin, selectors.EVENT_READ)
-            sel.register(self.resize_in, selectors.EVENT_READ)
-            sel.register(player.socket, selectors.EVENT_READ)
+            sel.register(
+                player.socket,
+                selectors.EVENT_READ,
+                lambda _: player.parse_progress(),
+            )
+            sel.register(fs.wake_in, selectors.EVENT_READ, fs.on_wake)
+            self.register(sel)
+            self.update()
             prev = time.time()
 
             while True:
                 player.finish_seek()
-
-                timeout = 0.5 if player.is_playing else None
+                playlist.step()
+                session.step()
+                self.tab.step_search()
+
+                if playlist.jobs or session.restoring or self.tab.searching:
+                    timeout = 0
+                elif player.is_playing or librarylist.updating:
+                    timeout = 0.5
+                else:
+                    timeout = None
                 for key, _mask in sel.select(timeout):
                     # if we have skipped multiple seconds, it is probably
                     # because the system was suspended. This heuristic is much
@@ -825,44 +2189,254 @@ class Application:
                         player.stop()
                     prev = time.time()
 
-                    if key.fileobj is self.resize_in:
-                        os.read(self.resize_in, 8)
-                        self.on_resize()
-                        self.render(force=True)
-                    elif key.fileobj is sys.stdin:
-                        self.process_key(self.screen.get_wch())
-                    elif key.fileobj is player.socket:
-                        player.parse_progress()
+                    key.data(key.fileobj)
 
                 if player.is_finished:
                     player.play(playlist.next())
+                prefetcher.update(playlist.peek(PREFETCH_AHEAD), player.path)
+
+                self.update()
+                session.tick()
+
+    def run(self):
+        with self.screen.open():
+            self.set_dimensions(self.screen.rows, self.screen.cols)
+            self.loop()
+
 
-                self.render()
+class Daemon(Application):
+    """Own player and playlist without a user interface.
 
+    Clients attach over a unix socket. They send keys and their terminal
+    size and receive the lines that changed since the last update. All
+    clients share a single session.
+    """
 
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.clients = []
+        self.current = None
+
+    def register(self, sel):
+        self.sel = sel
+        sel.register(self.server, selectors.EVENT_READ, self.on_connect)
+
+    def on_connect(self, server):
+        sock, _addr = server.accept()
+        # a client that stops reading must not block the daemon
+        sock.setblocking(False)
+        client = Connection(sock)
+        self.clients.append(client)
+        self.sel.register(
+            sock, selectors.EVENT_READ, lambda _: self.on_event(client)
+        )
+
+    def detach(self, client):
+        if client in self.clients:
+            self.sel.unregister(client.socket)
+            client.socket.close()
+            self.clients.remove(client)
+
+    def watch(self, client):
+        if client.closed or client.pending > CLIENT_BUFFER:
+            self.detach(client)
+        elif client in self.clients:
+            events = selectors.EVENT_READ
+            if client.pending:
+                events |= selectors.EVENT_WRITE
+            self.sel.modify(
+                client.socket, events, lambda _: self.on_event(client)
+            )
+
+    def on_event(self, client):
+        client.flush()
+        msgs = client.recv()
+        if msgs is None:
+            self.detach(client)
+            return
+        for msg in msgs:
+            try:
+                rows, cols = msg.get('size', (None, None))
+                size = None if rows is None else [int(rows), int(cols)]
+                key = msg.get('key')
+            except (AttributeError, TypeError, ValueError):
+                # malformed message
+                self.detach(client)
+                return
+            self.on_message(client, size, key)
+        self.watch(client)
+
+    def on_message(self, client, size, key):
+        self.current = client
+        if size:
+            client.size = size
+            self.set_dimensions(*client.size)
+            client.lines = []
+        if key is not None and client in self.clients:
+            # the most recently active client determines the layout
+            if client.size:
+                self.set_dimensions(*client.size)
+            self.process_key(key)
+
+    def quit(self):
+        self.detach(self.current)
+
+    def render_sizes(self, sizes):
+        # render once per terminal size without changing the scroll
+        # position of the most recently active client
+        rows, cols, position = self.rows, self.cols, self.tab.position
+        frames = {}
+        for size in sizes:
+            self.set_dimensions(*size)
+            frames[size] = (list(self._render()), self.cursor_row)
+        self.set_dimensions(rows, cols)
+        self.tab.position = position
+        return frames
+
+    def update(self):
+        if not self.clients:
+            return
+        frames = self.render_sizes({
+            tuple(client.size) for client in self.clients if client.size
+        })
+        for client in list(self.clients):
+            if not client.size:
+                continue
+            lines, cursor = frames[tuple(client.size)]
+            changed = [
+                [i, line] for i, line in enumerate(lines)
+                if i >= len(client.lines) or client.lines[i] != line
+            ]
+            if changed or cursor != client.cursor:
+                client.send({
+                    'lines': changed,
+                    'length': len(lines),
+                    'cursor': cursor,
+                })
+            client.lines = lines
+            client.cursor = cursor
+            self.watch(client)
+
+    def bind(self, server):
+        try:
+            server.bind(self.path)
+        except OSError:
+            # remove stale socket if no daemon is listening
+            with socket.socket(family=socket.AF_UNIX) as sock:
+                if sock.connect_ex(self.path) == 0:
+                    sys.exit(f'cplay-ng: daemon already running: {self.path}')
+            os.remove(self.path)
+            server.bind(self.path)
+
+    def run(self):
+        with socket.socket(family=socket.AF_UNIX) as server:
+            self.bind(server)
+            server.listen()
+            self.server = server
+            try:
+                self.loop()
+            finally:
+                os.remove(self.path)
+
+
+class Client:
+    """Render a session that is owned by a :class:`Daemon`."""
+
+    def __init__(self, path):
+        self.screen = Screen()
+        self.lines = []
+        self.cursor = 0
+        sock = socket.socket(family=socket.AF_UNIX)
+        try:
+            sock.connect(path)
+        except OSError:
+            sys.exit(f'cplay-ng: no daemon listening on {path}')
+        self.connection = Connection(sock)
+
+    def send_size(self):
+        self.connection.send({'size': [self.screen.rows, self.screen.cols]})
+
+    def apply(self, msg):
+        length = msg['length']
+        self.lines = self.lines[:length] + [''] * (length - len(self.lines))
+        for i, line in msg['lines']:
+            self.lines[i] = line
+        self.cursor = msg['cursor']
+
+    def run(self):
+        with self.screen.open(), selectors.DefaultSelector() as sel:
+            sel.register(sys.stdin, selectors.EVENT_READ)
+            sel.register(self.screen.resize_in, selectors.EVENT_READ)
+            sel.register(self.connection.socket, selectors.EVENT_READ)
+            self.send_size()
+
+            while True:
+                for key, _mask in sel.select():
+                    if key.fileobj is self.screen.resize_in:
+                        self.screen.on_resize()
+                        self.send_size()
+                        self.screen.draw(self.lines, self.cursor, force=True)
+                    elif key.fileobj is sys.stdin:
+                        self.connection.send({'key': self.screen.get_wch()})
+                    else:
+                        msgs = self.connection.recv()
+                        if msgs is None:
+                            return
+                        for msg in msgs:
+                            self.apply(msg)
+                        self.screen.draw(self.lines, self.cursor)
+
+
+def get_daemon_socket():
+    return '{}/cplay-ng.sock'.format(os.getenv('XDG_RUNTIME_DIR', '/tmp'))
+
+
+fs = Filesystem()
 player = Player()
+prefetcher = Prefetcher()
 playlist = Playlist()
 filelist = Filelist()
+librarylist = LibraryList()
 helplist = HelpList()
 app = Application()
+session = Session()
 
 
 def main():
-    app.screen = curses.initscr()
-    app.screen.keypad(True)  # noqa: FBT003
-    curses.cbreak()
-    curses.noecho()
-    curses.meta(True)  # noqa: FBT003
-    curses.curs_set(0)
-
-    signal.signal(signal.SIGWINCH, resize)
-
+    global app
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help='keep playing in the background and wait for clients to attach',
+    )
+    parser.add_argument(
+        '--attach',
+        action='store_true',
+        help='attach to a running daemon',
+    )
+    parser.add_argument('--socket', default=get_daemon_socket())
+    args = parser.parse_args()
+
+    if args.attach:
+        Client(args.socket).run()
+        return
+
+    # make sure the cleanup below also runs on SIGTERM
+    signal.signal(signal.SIGTERM, lambda *_args: sys.exit(0))
+    if args.daemon:
+        app = Daemon(args.socket)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    session.restore()
+    player.start(detach=args.daemon)
     try:
-        with enable_ctrl_keys():
-            app.run()
+        app.run()
     finally:
+        session.save()
         player.cleanup()
-        curses.endwin()
 
 
 if __name__ == '__main__':